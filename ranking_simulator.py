@@ -4,8 +4,10 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
+import numexpr as ne
 import ast
-import operator as op
+import io
 
 # -----------------------------
 # Page Config
@@ -20,16 +22,76 @@ st.title("🔁 Ranking Simulation & Comparison Tool")
 # -----------------------------
 # Load Data
 # -----------------------------
-@st.cache_data
+ALLOWED_VARIABLES = ("ranking_score", "asp_boost", "pop_boost")
+
+CATEGORY_COLUMNS = ("search_term", "ranking_cohort")
+
+@st.cache_resource
 def load_data():
-    return pd.read_csv("ranking_base_file.csv")
+    # Shared read-only by every rerun, so cache_resource avoids the
+    # per-call copy cache_data would hand out
+    df = pd.read_csv("ranking_base_file.csv")
+
+    if "ranking_cohort" not in df.columns:
+        df["ranking_cohort"] = "Unknown"
+
+    # Filter columns as categories so filters compare integer codes.
+    # Categories keep the file's order, which the sidebar lists them in.
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype(
+            pd.CategoricalDtype(df[column].dropna().unique())
+        )
+
+    # Rows of a search term become one contiguous block; the stable sort
+    # keeps file order within a term, which rank ties fall back on.
+    # Blank terms (code -1) go first so the codes stay non-decreasing
+    # for term_bounds' binary searches.
+    return df.sort_values(
+        "search_term", kind="stable", na_position="first", ignore_index=True
+    )
+
+
+@st.cache_resource
+def load_arrays():
+    # Columns the rerun path reads, as plain ndarrays; only the
+    # displayed rows ever go back through pandas
+    df = load_data()
+    term = df["search_term"].cat
+    cohort = df["ranking_cohort"].cat
+    return {
+        # Formula inputs as float32: half the bytes for numexpr to stream.
+        # The frame keeps full precision for the table and the download.
+        **{name: df[name].to_numpy(np.float32) for name in ALLOWED_VARIABLES},
+        "term_codes": term.codes.to_numpy(),
+        "terms": term.categories,
+        "cohort_codes": cohort.codes.to_numpy(),
+        "cohorts": cohort.categories,
+    }
+
+
+def term_bounds(store, search_term):
+    # The file is sorted by search term, so its rows are found with two
+    # binary searches instead of a scan over the full file
+    code = store["terms"].get_loc(search_term)
+    return (
+        np.searchsorted(store["term_codes"], code, side="left"),
+        np.searchsorted(store["term_codes"], code, side="right"),
+    )
+
+
+@st.cache_resource
+def sidebar_options():
+    # Widget choices for the static base file, worked out once from the
+    # same categories term_bounds and the cohort filter look labels up in
+    store = load_arrays()
+    return {
+        "terms": tuple(store["terms"]),
+        "cohorts": tuple(store["cohorts"]),
+    }
 
 
-df = load_data()
+options = sidebar_options()
 
-if "ranking_cohort" not in df.columns:
-    df["ranking_cohort"] = "Unknown"
-    
 #df["asp_boost"] = df["asp_boost"].fillna(0.0)
 #df["pop_boost"] = df["pop_boost"].fillna(0.0)
 # -----------------------------
@@ -39,11 +101,11 @@ st.sidebar.header("🔍 Filters")
 
 search_term = st.sidebar.selectbox(
     "Search Term",
-    (df["search_term"].unique())
+    options["terms"]
 )
 cohort_filter = st.sidebar.selectbox(
     "Ranking Cohort",
-    (df["ranking_cohort"].dropna().astype(str).unique())
+    options["cohorts"]
 )
 top_k = st.sidebar.slider(
     "Top K",
@@ -56,13 +118,21 @@ top_k = st.sidebar.slider(
 # -----------------------------
 # Apply Filters
 # -----------------------------
-filtered_df = df[df["search_term"] == search_term]
-filtered_df = filtered_df[filtered_df["ranking_cohort"] == cohort_filter]
+store = load_arrays()
+
+lo, hi = term_bounds(store, search_term)
+
+# Match the cohort on its integer category code rather than the label
+rows = lo + np.flatnonzero(
+    store["cohort_codes"][lo:hi] == store["cohorts"].get_loc(cohort_filter)
+)
 
-if filtered_df.empty:
+if rows.size == 0:
     st.warning("No data available for selected filters")
     st.stop()
 
+inputs = {name: store[name][rows] for name in ALLOWED_VARIABLES}
+
 # -----------------------------
 # Ranking Formula Inputs
 # -----------------------------
@@ -95,65 +165,63 @@ st.sidebar.markdown(
 # -----------------------------
 # Safe Expression Evaluator
 # -----------------------------
-ALLOWED_OPERATORS = {
-    ast.Add: op.add,
-    ast.Sub: op.sub,
-    ast.Mult: op.mul,
-    ast.Div: op.truediv,
-}
+ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div)
 
-def safe_eval_expr(expr, variables):
-    def _eval(node):
-        if isinstance(node, ast.Constant):  # numbers
-            return node.value
-
-        elif isinstance(node, ast.Name):  # variables
-            if node.id not in variables:
-                raise ValueError(f"Unknown variable: {node.id}")
-            return variables[node.id]
-
-        elif isinstance(node, ast.BinOp):  # a + b, a * b
-            if type(node.op) not in ALLOWED_OPERATORS:
-                raise TypeError("Operator not allowed")
-            return ALLOWED_OPERATORS[type(node.op)](
-                _eval(node.left),
-                _eval(node.right)
-            )
-
-        elif isinstance(node, ast.UnaryOp):  # -x
-            if isinstance(node.op, ast.USub):
-                return -_eval(node.operand)
+def validate_expr(node):
+    if isinstance(node, ast.Constant):  # numbers
+        if not isinstance(node.value, (int, float)):
+            raise TypeError("Unsupported expression")
+
+    elif isinstance(node, ast.Name):  # variables
+        if node.id not in ALLOWED_VARIABLES:
+            raise ValueError(f"Unknown variable: {node.id}")
+
+    elif isinstance(node, ast.BinOp):  # a + b, a * b
+        if not isinstance(node.op, ALLOWED_OPERATORS):
+            raise TypeError("Operator not allowed")
+        validate_expr(node.left)
+        validate_expr(node.right)
+
+    elif isinstance(node, ast.UnaryOp):  # -x
+        if not isinstance(node.op, ast.USub):
             raise TypeError("Unary operator not allowed")
+        validate_expr(node.operand)
 
-        else:
-            raise TypeError("Unsupported expression")
+    else:
+        raise TypeError("Unsupported expression")
 
-    parsed = ast.parse(expr, mode="eval")
-    return _eval(parsed.body)
 
+@st.cache_resource(max_entries=8)
+def validate_formula(expr):
+    # Formulas rarely change between reruns, check each one once
+    validate_expr(ast.parse(expr, mode="eval").body)
 
-def evaluate_formula(df, expr):
-    return safe_eval_expr(
-        expr,
-        {
-            "ranking_score": df["ranking_score"],
-            "asp_boost": df["asp_boost"],
-            "pop_boost": df["pop_boost"],
-        }
-    )
+
+def safe_eval_expr(expr, variables):
+    # Only whitelisted formulas reach numexpr, which then runs the
+    # whole expression as one fused loop over the arrays. An empty
+    # global_dict stops it from resolving names in the calling frame.
+    validate_formula(expr)
+    return ne.evaluate(expr, local_dict=variables, global_dict={})
+
+
+def evaluate_formula(inputs, expr):
+    scores = safe_eval_expr(expr, inputs)
+    # A formula without variables evaluates to a single number
+    if scores.ndim == 0:
+        scores = np.full(len(inputs["ranking_score"]), scores)
+    return scores
 
 # -----------------------------
 # Compute Scores
 # -----------------------------
 try:
-    df_sim = filtered_df.copy()
+    score_a = evaluate_formula(inputs, formula_a)
+    score_b = evaluate_formula(inputs, formula_b)
 
-    df_sim["score_a"] = evaluate_formula(df_sim, formula_a)
-    df_sim["score_b"] = evaluate_formula(df_sim, formula_b)
-
-    # Guardrails
-    df_sim["score_a"] = df_sim["score_a"].clip(lower=0)
-    df_sim["score_b"] = df_sim["score_b"].clip(lower=0)
+    # Guardrails (in place, the score arrays are freshly allocated)
+    np.maximum(score_a, 0, out=score_a)
+    np.maximum(score_b, 0, out=score_b)
 
 except Exception as e:
     st.error(f"❌ Formula Error: {e}")
@@ -162,22 +230,43 @@ except Exception as e:
 # -----------------------------
 # Rank Computation
 # -----------------------------
-df_sim["rank_a"] = df_sim["score_a"].rank(
-    method="first", ascending=False
-)
+def rank_first_desc(scores, positions):
+    # Same as Series.rank(method="first", ascending=False), ties keep row order
+    order = np.argsort(-scores, kind="stable")
+    ranks = np.empty_like(order)
+    ranks[order] = positions
+    return ranks, order
+
+
+def rank_pipeline(score_a, score_b, top_k):
+    # Both rankings, their delta and the Top-K rows straight from the
+    # two sort orders, without going through intermediate Series
+    positions = np.arange(1, score_a.size + 1)
+    rank_a, order_a = rank_first_desc(score_a, positions)
+    rank_b, order_b = rank_first_desc(score_b, positions)
+
+    # The first K positions of each sort order are the Top-K rows,
+    # so there is no need to rescan every rank
+    topk_rows = np.union1d(order_a[:top_k], order_b[:top_k])
+
+    return rank_a, rank_b, rank_b - rank_a, topk_rows
 
-df_sim["rank_b"] = df_sim["score_b"].rank(
-    method="first", ascending=False
-)
 
-df_sim["rank_delta"] = df_sim["rank_b"] - df_sim["rank_a"]
+rank_a, rank_b, rank_delta, topk_rows = rank_pipeline(
+    score_a, score_b, top_k
+)
 
 # -----------------------------
 # Top-K Selection
 # -----------------------------
-topk_df = df_sim[
-    (df_sim["rank_a"] <= top_k) | (df_sim["rank_b"] <= top_k)
-].sort_values("rank_a")
+# Scores and ranks stay as arrays, only the displayed rows get columns
+topk_df = load_data().iloc[rows[topk_rows]].assign(
+    score_a=score_a[topk_rows],
+    score_b=score_b[topk_rows],
+    rank_a=rank_a[topk_rows],
+    rank_b=rank_b[topk_rows],
+    rank_delta=rank_delta[topk_rows],
+).sort_values("rank_a")
 
 # -----------------------------
 # Display Ranking Table
@@ -199,9 +288,7 @@ display_cols = [
 ]
 
 st.dataframe(
-    topk_df[display_cols]
-        .sort_values("rank_a")
-        .reset_index(drop=True),
+    topk_df[display_cols].reset_index(drop=True),
     use_container_width=True
 )
 
@@ -210,25 +297,27 @@ st.dataframe(
 # -----------------------------
 st.subheader("📈 Summary Metrics")
 
+def summarize_delta(delta):
+    # Improved / unchanged / dropped counts from a single pass over the signs
+    improved, _, dropped = np.bincount(np.sign(delta) + 1, minlength=3)
+    return np.abs(delta).mean(), improved, dropped
+
+
+avg_shift, improved, dropped = summarize_delta(rank_delta[topk_rows])
+
 col1, col2, col3, col4 = st.columns(4)
 
 with col1:
-    overlap = len(
-        set(df_sim[df_sim["rank_a"] <= top_k]["product_variant_id"])
-        & set(df_sim[df_sim["rank_b"] <= top_k]["product_variant_id"])
-    )
+    overlap = np.count_nonzero((rank_a <= top_k) & (rank_b <= top_k))
     st.metric("Top-K Overlap", f"{overlap}/{top_k}")
 
 with col2:
-    avg_shift = topk_df["rank_delta"].abs().mean()
     st.metric("Avg |Rank Change|", f"{avg_shift:.2f}")
 
 with col3:
-    improved = (topk_df["rank_delta"] < 0).sum()
     st.metric("Products Improved", improved)
 
 with col4:
-    dropped = (topk_df["rank_delta"] > 0).sum()
     st.metric("Products Dropped", dropped)
 
 # -----------------------------
@@ -236,10 +325,17 @@ with col4:
 # -----------------------------
 st.subheader("📉 Rank Change Distribution")
 
+# Deltas are bounded integers, so count them with an offset bincount
+lowest = rank_delta.min()
+delta_counts = np.bincount(rank_delta - lowest)
+seen = np.flatnonzero(delta_counts)
+
 st.bar_chart(
-    df_sim["rank_delta"]
-        .value_counts()
-        .sort_index()
+    pd.Series(
+        delta_counts[seen],
+        index=pd.Index(seen + lowest, name="rank_delta"),
+        name="count"
+    )
 )
 
 # -----------------------------
@@ -247,7 +343,19 @@ st.bar_chart(
 # -----------------------------
 st.subheader("⬇️ Download Results")
 
-csv = topk_df.to_csv(index=False).encode("utf-8")
+@st.cache_data(max_entries=8)
+def encode_csv(_topk_df, selection):
+    # The Top-K frame is fully determined by the selection, so key the
+    # cache on that instead of hashing the frame itself
+    buffer = io.BytesIO()
+    _topk_df.to_csv(buffer, index=False, encoding="utf-8")
+    return buffer.getvalue()
+
+
+csv = encode_csv(
+    topk_df,
+    (search_term, cohort_filter, formula_a, formula_b, top_k)
+)
 
 st.download_button(
     label="Download Ranking Comparison CSV",